@@ -6,7 +6,7 @@ Ticket CSV Downloader & Aggregator from .eml Emails
 This script:
 1. Parses a .eml email file
 2. Extracts all hyperlinks ending in .csv
-3. Downloads each CSV file (with retry logic)
+3. Downloads each CSV file concurrently (with retry logic)
 4. Logs download and aggregation process
 5. Combines all CSVs into one (single header)
 6. Stores everything in a timestamped output folder
@@ -14,20 +14,43 @@ This script:
 
 Usage:
     python download_tickets.py --email emails/tickets.eml --name JulyCampaign
+    python download_tickets.py --email emails/tickets.eml --name JulyCampaign --fast
 """
 
 import os
 import sys
 import re
 import csv
+import hashlib
+import html
+import random
+import shutil
+import codecs
 import time
 import argparse
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from email import message_from_file
-from urllib.parse import urlparse
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+from email import policy
+from email.parser import BytesParser
+from urllib.parse import urlparse, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Chunk size used when streaming bytes between file-like objects
+BUFFER_SIZE = 1 << 20  # 1 MiB
+
+# Byte-order mark some exporters put at the start of UTF-8 CSVs
+_UTF8_BOM = codecs.BOM_UTF8
+
+# Precompiled pattern matching <a> hrefs that point at a .csv (query string allowed)
+# (bytes pattern, so HTML bodies never need decoding)
+_CSV_HREF_RE = re.compile(
+    rb'<a[^>]+href=["\']\s*([^"\']*?\.csv(?:\?[^"\'\s]*)?)\s*["\'][^>]*>', re.IGNORECASE
+)
 
 
 class TicketCSVDownloader:
@@ -35,17 +58,20 @@ class TicketCSVDownloader:
     Main class to handle downloading and aggregating CSVs from .eml email files.
     """
 
-    def __init__(self, eml_path: str, output_name: str, base_output_dir: str = "output"):
+    def __init__(self, eml_path: str, output_name: str, base_output_dir: str = "output",
+                 fast: bool = False):
         """
         Initialize the downloader.
 
         :param eml_path: Path to the .eml email file
         :param output_name: User-defined name for output (e.g., "JulyCampaign")
         :param base_output_dir: Base directory to store outputs
+        :param fast: Aggregate with pyarrow.csv when it is installed
         """
         self.eml_path = eml_path
         self.output_name = output_name
         self.base_output_dir = base_output_dir
+        self.fast = fast
 
         # Derived paths
         self.timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -56,17 +82,41 @@ class TicketCSVDownloader:
 
         # Retry settings
         self.retry_attempts = 3
-        self.retry_delay = 2  # seconds
+        self.retry_delay = 2  # seconds (base delay, doubled per attempt)
         self.timeout = 10  # seconds
         self.user_agent = "TicketCSV-Downloader/1.0"
 
+        # Concurrency settings
+        self.max_workers = 32
+
+        # HTTP session (pooled keep-alive connections shared across workers)
+        self.session = self._create_session()
+
         # Logging
         self.download_logger = None
         self.agg_logger = None
+        self.log_listeners = []  # (logger, queue_handler, listener) triples
 
         self._setup_directories()
         self._setup_logging()
 
+    def _create_session(self) -> requests.Session:
+        """
+        Create a pooled HTTP session so connections to the same host are reused.
+
+        :return: Configured requests session
+        """
+        session = requests.Session()
+        session.headers["User-Agent"] = self.user_agent
+        adapter = HTTPAdapter(
+            pool_connections=self.max_workers,
+            pool_maxsize=self.max_workers,
+            max_retries=0,  # Retries are handled in download_file
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
     def _setup_directories(self):
         """Create necessary directories if they don't exist."""
         os.makedirs(self.base_output_dir, exist_ok=True)
@@ -96,10 +146,29 @@ class TicketCSVDownloader:
         handler = logging.FileHandler(log_path, mode="a", encoding="utf-8")
         formatter = logging.Formatter(fmt="%(message)s")
         handler.setFormatter(formatter)
-        logger.addHandler(handler)
+
+        # Workers only enqueue records; a background listener does the file I/O
+        log_queue = queue.Queue(-1)
+        queue_handler = QueueHandler(log_queue)
+        logger.addHandler(queue_handler)
+        listener = QueueListener(log_queue, handler)
+        listener.start()
+        self.log_listeners.append((logger, queue_handler, listener))
+
         logger.propagate = False  # Prevent duplicate logs
         return logger
 
+    def close(self):
+        """Release the HTTP session and flush/stop the background log listeners."""
+        self.session.close()
+        for logger, queue_handler, listener in self.log_listeners:
+            # Loggers are process-global; detach so later instances don't feed a dead queue
+            logger.removeHandler(queue_handler)
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+        self.log_listeners = []
+
     def extract_csv_urls(self) -> list:
         """
         Extract all .csv URLs from the HTML body of the .eml file.
@@ -111,28 +180,28 @@ class TicketCSVDownloader:
             return []
 
         try:
-            with open(self.eml_path, "r", encoding="utf-8", errors="ignore") as f:
-                msg = message_from_file(f)
+            with open(self.eml_path, "rb") as f:
+                msg = BytesParser(policy=policy.default).parse(f)
 
-            body = ""
+            # Undo transfer-encoding only; hrefs are ASCII so charsets don't matter
             if msg.is_multipart():
-                for part in msg.walk():
-                    content_disposition = str(part.get("Content-Disposition", ""))
-                    if "attachment" not in content_disposition:
-                        content_type = part.get_content_type()
-                        if content_type == "text/html":
-                            payload = part.get_payload(decode=True)
-                            if payload:
-                                body += payload.decode("utf-8", errors="ignore")
+                # Check the content type first: most parts (images, text/plain)
+                # fail it, so Content-Disposition is only parsed for HTML parts
+                payloads = [
+                    part.get_payload(decode=True) or b""
+                    for part in msg.walk()
+                    if part.get_content_type() == "text/html" and not part.is_attachment()
+                ]
             else:
-                payload = msg.get_payload(decode=True)
-                if payload:
-                    body = payload.decode("utf-8", errors="ignore")
-
-            # Extract all hrefs from <a> tags
-            links = re.findall(r'<a[^>]+href=["\']([^"\']+)["\'][^>]*>', body, re.IGNORECASE)
-            # Filter only those ending with .csv
-            csv_urls = [url.strip() for url in links if url.lower().endswith(".csv")]
+                payloads = [msg.get_payload(decode=True) or b""]
+
+            # Scan each part in place rather than concatenating them into one body;
+            # hrefs are HTML attribute values, so undo entities such as &amp;
+            csv_urls = [
+                html.unescape(m.group(1).decode("ascii", errors="ignore")).strip()
+                for payload in payloads
+                for m in _CSV_HREF_RE.finditer(payload)
+            ]
             self.agg_logger.info(f"Found {len(csv_urls)} .csv URLs in email.")
             return csv_urls
 
@@ -140,121 +209,280 @@ class TicketCSVDownloader:
             self.download_logger.error(f"FAILED TO PARSE EMAIL: {str(e)}")
             return []
 
-    def download_file(self, url: str) -> str:
+    def _backoff_delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with jitter, so concurrent retries don't synchronize.
+
+        :param attempt: 1-based number of the attempt that just failed
+        :return: Seconds to sleep before the next attempt
+        """
+        return self.retry_delay * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+
+    def _dedupe_urls(self, urls: list) -> list:
+        """
+        Drop repeated URLs, keeping first-seen order. URLs that differ only in
+        scheme/host case or fragment are treated as the same download.
+
+        :param urls: URLs extracted from the email
+        :return: Unique URLs
+        """
+        unique = {}
+        for url in dict.fromkeys(urls):
+            parts = urlsplit(url)
+            key = parts._replace(
+                scheme=parts.scheme.lower(), netloc=parts.netloc.lower(), fragment=""
+            ).geturl()
+            unique.setdefault(key, url)
+        return list(unique.values())
+
+    def _assign_filenames(self, urls: list) -> list:
+        """
+        Pick a distinct target filename for every URL before downloading, so
+        concurrent workers never write to the same file (or .part file).
+
+        :param urls: URLs to download
+        :return: Filenames, in the same order as urls
+        """
+        filenames = []
+        taken = set()
+        for index, url in enumerate(urls, start=1):
+            parsed = urlparse(url)
+            filename = os.path.basename(parsed.path)
+            if not filename or "." not in filename:
+                filename = f"download_{index}.csv"
+
+            stem, ext = os.path.splitext(filename)
+            # Export links often differ only by query string (export.csv?id=1)
+            if parsed.query:
+                query_hash = hashlib.sha1(parsed.query.encode("utf-8")).hexdigest()[:8]
+                stem = f"{stem}_{query_hash}"
+                filename = f"{stem}{ext}"
+            suffix = 1
+            while filename.lower() in taken:
+                suffix += 1
+                filename = f"{stem}_{suffix}{ext}"
+            taken.add(filename.lower())
+            filenames.append(filename)
+        return filenames
+
+    def _remove_partial(self, part_path: str):
+        """
+        Delete the .part file left by a failed download, if any.
+
+        :param part_path: Path of the partial download
+        """
+        try:
+            os.remove(part_path)
+        except FileNotFoundError:
+            pass
+
+    def download_file(self, url: str, filename: str = None) -> str:
         """
         Download a single CSV file with retry logic.
 
         :param url: URL to download
+        :param filename: Target filename in raw_downloads (derived from the URL if omitted)
         :return: Full path to saved file, or None if failed
         """
-        filename = os.path.basename(urlparse(url).path)
-        if not filename or "." not in filename:
-            filename = f"download_{int(time.time())}.csv"
+        if filename is None:
+            filename = self._assign_filenames([url])[0]
 
         filepath = os.path.join(self.raw_dir, filename)
+        # Write to a .part file and rename once complete, so an
+        # interrupted download never looks like a finished CSV
+        part_path = filepath + ".part"
 
         for attempt in range(1, self.retry_attempts + 1):
             try:
-                req = Request(url, headers={"User-Agent": self.user_agent})
-                with urlopen(req, timeout=self.timeout) as response:
-                    if response.status == 200:
-                        data = response.read()
-                        with open(filepath, "wb") as f:
-                            f.write(data)
+                with self.session.get(url, timeout=self.timeout, stream=True) as response:
+                    if response.status_code == 200:
+                        # requests advertises every encoding it can decode (gzip,
+                        # deflate, plus br/zstd when installed); decode while streaming
+                        response.raw.decode_content = True
+                        with open(part_path, "wb", buffering=BUFFER_SIZE) as f:
+                            shutil.copyfileobj(response.raw, f, BUFFER_SIZE)
+                        os.replace(part_path, filepath)
                         self.download_logger.info(f"DOWNLOAD: {url} -> {filename} - SUCCESS")
                         return filepath
                     else:
-                        msg = f"HTTP {response.status}"
+                        msg = f"HTTP {response.status_code}"
                         if attempt < self.retry_attempts:
-                            time.sleep(self.retry_delay)
+                            time.sleep(self._backoff_delay(attempt))
                             continue
+                        self._remove_partial(part_path)
                         self.download_logger.error(f"DOWNLOAD: {url} -> {filename} - FAILED ({msg})")
                         return None
 
-            except HTTPError as e:
-                msg = f"HTTP {e.code}"
-                if attempt < self.retry_attempts:
-                    time.sleep(self.retry_delay)
-                    continue
-                self.download_logger.error(f"DOWNLOAD: {url} -> {filename} - FAILED ({msg})")
-                return None
-
-            except URLError as e:
-                msg = str(e.reason) if hasattr(e, "reason") else str(e)
+            except requests.RequestException as e:
+                msg = str(e)
                 if attempt < self.retry_attempts:
-                    time.sleep(self.retry_delay)
+                    time.sleep(self._backoff_delay(attempt))
                     continue
+                self._remove_partial(part_path)
                 self.download_logger.error(f"DOWNLOAD: {url} -> {filename} - FAILED ({msg})")
                 return None
 
             except Exception as e:
                 msg = str(e)
                 if attempt < self.retry_attempts:
-                    time.sleep(self.retry_delay)
+                    time.sleep(self._backoff_delay(attempt))
                     continue
+                self._remove_partial(part_path)
                 self.download_logger.error(f"DOWNLOAD: {url} -> {filename} - FAILED ({msg})")
                 return None
 
         return None
 
+    def _copy_rows(self, src, dst) -> int:
+        """
+        Copy the remaining bytes of src into dst, counting lines on the way.
+
+        :param src: Binary file object positioned after any header line
+        :param dst: Binary file object to append to
+        :return: Number of data rows copied
+        """
+        row_count = 0
+        last_byte = b"\n"
+        for chunk in iter(lambda: src.read(BUFFER_SIZE), b""):
+            dst.write(chunk)
+            row_count += chunk.count(b"\n")
+            last_byte = chunk[-1:]
+
+        # Terminate a trailing row so the next file doesn't join onto it
+        if last_byte != b"\n":
+            dst.write(b"\n")
+            row_count += 1
+        return row_count
+
+    def _aggregate_with_arrow(self, csv_files: list, combined_path: str) -> bool:
+        """
+        Parse every CSV with pyarrow.csv and write the concatenated table.
+        Columns are matched by header name; missing columns are left empty.
+        Every column is read as a string so values round-trip unchanged
+        (e.g. "00123" stays "00123") and differing inferred types can't clash.
+
+        :param csv_files: DirEntry objects for the CSVs to combine
+        :param combined_path: Path of the combined output CSV
+        :return: True on success, False if the caller should fall back
+        """
+        # Optional dependency, imported here so runs without --fast don't pay for it
+        try:
+            import pyarrow
+            import pyarrow.csv as pa_csv
+        except ImportError:
+            self.agg_logger.info("pyarrow not installed - using standard aggregation.")
+            return False
+
+        try:
+            tables = []
+            file_logs = []
+            for entry in csv_files:
+                file = entry.name
+                if entry.stat().st_size == 0:
+                    file_logs.append(f"{file} - SKIPPED (empty)")
+                    continue
+
+                with open(entry.path, "r", newline="", encoding="utf-8-sig") as f:
+                    header = next(csv.reader(f), [])
+                convert_options = pa_csv.ConvertOptions(
+                    column_types={name: pyarrow.string() for name in header}
+                )
+                table = pa_csv.read_csv(entry.path, convert_options=convert_options)
+                tables.append(table)
+                file_logs.append(f"{file} - ADDED ({table.num_rows} rows)")
+
+            if not tables:
+                return False  # All empty: let the standard path write the output
+
+            combined = pyarrow.concat_tables(tables, promote_options="default")
+            pa_csv.write_csv(combined, combined_path)
+
+        except Exception as e:
+            self.agg_logger.info(f"FAST AGGREGATION FAILED ({str(e)}) - using standard aggregation.")
+            return False
+
+        for line in file_logs:
+            self.agg_logger.info(line)
+        final_row_count = combined.num_rows + 1
+        self.agg_logger.info(f"FINAL: combined_{self.output_name}.csv - CREATED ({final_row_count} rows)")
+        print(f"Aggregation complete: {combined_path}")
+        return True
+
     def aggregate_csv_files(self):
         """
         Combine all downloaded CSVs into one file (single header).
-        Skips header rows in subsequent files.
+        Skips header rows in subsequent files. Unfinished *.csv.part
+        downloads are ignored.
+
+        Files are concatenated as raw bytes. The first file's header line is
+        remembered and a later file's first line is dropped only if it matches.
         """
-        csv_files = [f for f in os.listdir(self.raw_dir) if f.lower().endswith(".csv")]
+        with os.scandir(self.raw_dir) as it:
+            csv_files = [e for e in it if e.is_file() and e.name.lower().endswith(".csv")]
+        # Largest first, so small files are appended while the page cache is warm
+        csv_files.sort(key=lambda e: e.stat().st_size, reverse=True)
         combined_path = os.path.join(self.output_dir, f"combined_{self.output_name}.csv")
 
         if not csv_files:
             self.agg_logger.info("No CSV files to aggregate.")
             return
 
-        header_written = False
+        # A single CSV needs no header handling: copy it straight through,
+        # counting lines on the way (raw download is kept)
+        if len(csv_files) == 1 and csv_files[0].stat().st_size > 0:
+            try:
+                with open(csv_files[0].path, "rb", buffering=BUFFER_SIZE) as src, \
+                        open(combined_path, "wb", buffering=BUFFER_SIZE) as dst:
+                    final_row_count = self._copy_rows(src, dst)
+                self.agg_logger.info(f"{csv_files[0].name} - ADDED ({final_row_count - 1} rows)")
+                self.agg_logger.info(f"FINAL: combined_{self.output_name}.csv - CREATED ({final_row_count} rows)")
+                print(f"Aggregation complete: {combined_path}")
+            except Exception as e:
+                self.agg_logger.info(f"AGGREGATION FAILED: {str(e)}")
+            return
+
+        if self.fast:
+            if self._aggregate_with_arrow(csv_files, combined_path):
+                return
+
+        header_line = None
+        header_key = None  # header without BOM or line ending, computed once
         total_data_rows = 0
 
         try:
-            with open(combined_path, "w", newline="", encoding="utf-8") as combined:
-                writer = None
-
-                for file in csv_files:
-                    filepath = os.path.join(self.raw_dir, file)
+            with open(combined_path, "wb", buffering=BUFFER_SIZE) as combined:
+                for entry in csv_files:
+                    file = entry.name
                     try:
-                        with open(filepath, "r", encoding="utf-8") as f:
-                            sample = f.read(1024)
-                            f.seek(0)
-                            has_header = False
-                            try:
-                                has_header = csv.Sniffer().has_header(sample)
-                            except csv.Error:
-                                pass  # Can't detect header, assume no
-
-                            reader = csv.reader(f)
-                            rows = list(reader)
-
-                        if not rows:
-                            self.agg_logger.info(f"{file} - SKIPPED (empty)")
-                            continue
+                        with open(entry.path, "rb", buffering=BUFFER_SIZE) as f:
+                            first_line = f.readline()
+                            if not first_line:
+                                self.agg_logger.info(f"{file} - SKIPPED (empty)")
+                                continue
+                            bom_len = len(_UTF8_BOM) if first_line.startswith(_UTF8_BOM) else 0
+
+                            if header_line is None:
+                                if not first_line.endswith(b"\n"):
+                                    first_line += b"\n"
+                                combined.write(first_line)
+                                header_line = first_line
+                                header_key = first_line[bom_len:].rstrip(b"\r\n")
+                                row_count = self._copy_rows(f, combined)
+                            elif (first_line == header_line
+                                  or first_line[bom_len:].rstrip(b"\r\n") == header_key):
+                                row_count = self._copy_rows(f, combined)
+                            else:
+                                # No matching header: the first line is data (minus any BOM)
+                                f.seek(bom_len)
+                                row_count = self._copy_rows(f, combined)
 
-                        if not writer:
-                            writer = csv.writer(combined)
-
-                        if not header_written:
-                            writer.writerow(rows[0])
-                            header_written = True
-                            data_rows = rows[1:]
-                        else:
-                            data_rows = rows[1:] if has_header else rows
-
-                        row_count = len(data_rows)
-                        for row in data_rows:
-                            writer.writerow(row)
                         total_data_rows += row_count
                         self.agg_logger.info(f"{file} - ADDED ({row_count} rows)")
 
                     except Exception as e:
                         self.agg_logger.info(f"{file} - FAILED ({str(e)})")
 
-            final_row_count = total_data_rows + (1 if header_written else 0)
+            final_row_count = total_data_rows + (1 if header_line is not None else 0)
             self.agg_logger.info(f"FINAL: combined_{self.output_name}.csv - CREATED ({final_row_count} rows)")
             print(f"Aggregation complete: {combined_path}")
 
@@ -265,27 +493,36 @@ class TicketCSVDownloader:
         """
         Execute the full pipeline: extract → download → aggregate.
         """
-        print(f"Parsing email: {self.eml_path}")
-        print(f"Output folder: {self.output_dir}")
-
-        # Step 1: Extract CSV URLs
-        urls = self.extract_csv_urls()
-        if not urls:
-            print(" No .csv URLs found in email.")
-            return
-
-        # Step 2: Download each URL
-        downloaded_files = []
-        for url in urls:
-            filepath = self.download_file(url)
-            if filepath:
-                downloaded_files.append(filepath)
-
-        print(f" Downloaded {len(downloaded_files)} out of {len(urls)} files.")
-
-        # Step 3: Aggregate all CSVs
-        self.aggregate_csv_files()
-        print(f"Process complete. Check logs in: {self.logs_dir}")
+        try:
+            print(f"Parsing email: {self.eml_path}")
+            print(f"Output folder: {self.output_dir}")
+
+            # Step 1: Extract CSV URLs
+            urls = self.extract_csv_urls()
+            if not urls:
+                print(" No .csv URLs found in email.")
+                return
+            urls = self._dedupe_urls(urls)
+
+            # Step 2: Download each URL concurrently (I/O-bound)
+            downloaded_files = []
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(urls))) as executor:
+                futures = [
+                    executor.submit(self.download_file, url, filename)
+                    for url, filename in zip(urls, self._assign_filenames(urls))
+                ]
+                for future in as_completed(futures):
+                    filepath = future.result()
+                    if filepath:
+                        downloaded_files.append(filepath)
+
+            print(f" Downloaded {len(downloaded_files)} out of {len(urls)} files.")
+
+            # Step 3: Aggregate all CSVs
+            self.aggregate_csv_files()
+            print(f"Process complete. Check logs in: {self.logs_dir}")
+        finally:
+            self.close()
 
 
 def main():
@@ -295,11 +532,13 @@ def main():
     )
     parser.add_argument("--email", required=True, help="Path to the .eml file (e.g., emails/alert.eml)")
     parser.add_argument("--name", required=True, help="Custom name for output (e.g., JulyCampaign)")
+    parser.add_argument("--fast", action="store_true",
+                        help="Aggregate with pyarrow (if installed) for large CSVs")
 
     args = parser.parse_args()
 
     # Instantiate and run
-    downloader = TicketCSVDownloader(eml_path=args.email, output_name=args.name)
+    downloader = TicketCSVDownloader(eml_path=args.email, output_name=args.name, fast=args.fast)
     downloader.run()
 
 